@@ -1,15 +1,31 @@
 #!/usr/bin/env python
 import argparse
-import ipaddress
-import multiprocessing
-import shutil
+import asyncio
+import logging
 import socket
+import struct
 import sys
-import urllib
+import tempfile
+import threading
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from email.utils import formatdate
 from functools import lru_cache, partial
+from http.client import HTTPException, HTTPSConnection
 from pathlib import Path
-from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+from urllib.request import Request, getproxies, proxy_bypass, urlopen
+
+try:
+    import aiodns
+except ImportError:
+    aiodns = None
+
+try:
+    import pytricia
+except ImportError:
+    pytricia = None
 
 __copyright__ = "Copyright 2024, Sergey M"
 __license__ = "MIT"
@@ -25,14 +41,33 @@ PURPLE = "\x1b[35m"
 CYAN = "\x1b[36m"
 WHITE = "\x1b[37m"
 
+# Префиксы сообщений, которые выводятся для каждого хоста
+DETECTED_MSG = PURPLE + "detected cloudflare: "
+NOT_FOUND_MSG = PURPLE + "host ip address not found: "
+SKIP_HOST_MSG = PURPLE + "skip host: "
+
 CLOUD_CACHE_PATH = Path.home() / ".cache" / "clowdflare"
 CLOUD_IPSV4_PATH = CLOUD_CACHE_PATH / "ips-v4"
 CLOUD_IPSV6_PATH = CLOUD_CACHE_PATH / "ips-v6"
 CLOUD_IPSV4_URL = "https://www.cloudflare.com/ips-v4/"
 CLOUD_IPSV6_URL = "https://www.cloudflare.com/ips-v6/"
 
+ASYNC_MAX_QUERIES = 1024
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+# Таблицы подсетей cloudflare, заполняются один раз в init_subnets: префиксные
+# деревья pytricia, если он установлен, иначе для IPv4 список из 65536 корзин
+# по старшим 16 битам адреса, а для IPv6 отсортированные начала и концы
+# диапазонов
+_V4 = [None] * 65536
+_V6 = ([], [])
+
+unpack_ip4 = struct.Struct(">I").unpack
+unpack_ip6 = struct.Struct(">QQ").unpack
+
 
 stderr = partial(print, file=sys.stderr)
+log = logging.getLogger(__name__)
 
 
 def parse_args(argv):
@@ -57,10 +92,25 @@ def parse_args(argv):
     parser.add_argument(
         "-p",
         "--proc",
-        help="max number of parallel processes",
-        default=max(multiprocessing.cpu_count() - 1, 2),
+        help="max number of parallel threads",
+        default=128,
         type=int,
     )
+    parser.add_argument(
+        "-a",
+        "--async",
+        help="resolve hosts asynchronously with aiodns instead of threads",
+        dest="use_async",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="log every checked host ip",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+    )
     parser.add_argument(
         "-F",
         "--force-download-ips",
@@ -84,88 +134,244 @@ def parse_args(argv):
 def main(argv=None):
     args = parse_args(argv=argv)
 
+    logging.basicConfig(format=CYAN + "%(message)s" + RESET)
+    log.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
     hosts = args.hosts.copy()
 
     if not args.list.isatty():
         hosts.extend(map(str.strip, args.list))
 
+    # Убираем повторы с сохранением порядка и пустые строки
+    hosts = [host for host in dict.fromkeys(hosts) if host]
+
+    if args.use_async and aiodns is None:
+        stderr(RED + "aiodns is required for async mode: pip install aiodns" + RESET)
+        return 1
+
+    ips_data = [None, None]
     if not args.skip_download_ips:
-        for url, path in [
-            (CLOUD_IPSV4_URL, CLOUD_IPSV4_PATH),
-            (CLOUD_IPSV6_URL, CLOUD_IPSV6_PATH),
-        ]:
-            download_file(url, path, args.force_download_ips)
+        # Оба списка лежат на одном хосте, поэтому качаем их через одно
+        # соединение и не тратим время на повторное рукопожатие TLS
+        conn = open_connection(CLOUD_IPSV4_URL)
+        try:
+            ips_data = [
+                download_file(conn, url, path, args.force_download_ips)
+                for url, path in [
+                    (CLOUD_IPSV4_URL, CLOUD_IPSV4_PATH),
+                    (CLOUD_IPSV6_URL, CLOUD_IPSV6_PATH),
+                ]
+            ]
+        finally:
+            if conn is not None:
+                conn.close()
 
-    proc_num = min(args.proc, len(hosts))
+    # Загружаем подсети до запуска потоков, чтобы все они использовали одни и
+    # те же таблицы
+    try:
+        init_subnets(*ips_data)
+    except FileNotFoundError as err:
+        stderr(RED + "cloudflare ip list not found: " + err.filename + RESET)
+        return 1
+
+    if args.use_async:
+        stderr(YELLOW, "total hosts: ", len(hosts), "; async mode", RESET, sep="")
+        try:
+            asyncio.run(check_hosts_async(hosts))
+            stderr(YELLOW + "Finished!" + RESET)
+        except KeyboardInterrupt:
+            stderr(YELLOW + "Program interrupted by user..." + RESET)
+        return
+
+    threads_num = max(min(args.proc, len(hosts)), 1)
 
     stderr(
         YELLOW,
         "total hosts: ",
         len(hosts),
-        "; parallel processes: ",
-        proc_num,
+        "; parallel threads: ",
+        threads_num,
         RESET,
         sep="",
     )
-    with multiprocessing.Pool(proc_num) as pool:
+    # Резолвинг упирается в ожидание ответа DNS, а не в процессор, поэтому
+    # потоков хватает
+    with ThreadPoolExecutor(threads_num) as executor:
         try:
-            for host, checked in pool.imap_unordered(check_host, hosts):
-                if checked:
-                    print(host)
-                else:
-                    stderr(PURPLE + "skip host:", host + RESET)
+            for future in as_completed(
+                executor.submit(check_host, host) for host in hosts
+            ):
+                print_result(*future.result())
             stderr(YELLOW + "Finished!" + RESET)
         except KeyboardInterrupt:
+            executor.shutdown(cancel_futures=True)
             stderr(YELLOW + "Program interrupted by user..." + RESET)
 
 
-@lru_cache
-def get_cloudflare_subnets():
+def parse_ip(ip):
+    # Адрес переводим в пару (семейство, число), без объектов ipaddress
+    if ":" in ip:
+        hi, lo = unpack_ip6(socket.inet_pton(socket.AF_INET6, ip))
+        return socket.AF_INET6, hi << 64 | lo
+    return socket.AF_INET, unpack_ip4(socket.inet_aton(ip))[0]
+
+
+def parse_subnet(ip_mask):
+    # Переводим подсеть вида "a.b.c.d/n" в диапазон (первый, последний адрес)
+    # из целых чисел, не создавая объектов ipaddress
+    ip, _, prefix = ip_mask.partition("/")
+    family, ip_int = parse_ip(ip)
+    bits = 128 if family == socket.AF_INET6 else 32
+    full = (1 << bits) - 1
+    mask = (full << (bits - int(prefix or bits))) & full
+    start = ip_int & mask
+    return start, start | (~mask & full)
+
+
+def load_cloudflare_subnets(v4_data=None, v6_data=None):
+    # Только что скачанные списки разбираем из памяти, остальные читаем из кеша
     rv = []
-    for path, ip_net in [
-        (CLOUD_IPSV4_PATH, ipaddress.IPv4Network),
-        (CLOUD_IPSV6_PATH, ipaddress.IPv6Network),
-    ]:
-        for ip_mask in filter(None, map(str.strip, path.open())):
-            rv.append(ip_net(ip_mask))
+    for path, data in [(CLOUD_IPSV4_PATH, v4_data), (CLOUD_IPSV6_PATH, v6_data)]:
+        text = path.read_text() if data is None else data.decode()
+        # split() без аргументов сам отбрасывает пробелы и пустые строки
+        rv.append(text.split())
     return rv
 
 
-def get_ip4(host, port=0):
-    return next(
-        filter(
-            lambda x: x[0] == socket.AF_INET,
-            socket.getaddrinfo(host, port),
-        )
-    )[4][0]
-
-
-def check_cloudflare(host):
-    ip = ipaddress.IPv4Address(get_ip4(host))
-    for subnet in get_cloudflare_subnets():
-        stderr(
-            CYAN
-            + "check {} ({}) in cloudflare subnet {}: {}".format(
-                host, ip.compressed, subnet.compressed, ["-", "+"][ip in subnet]
-            )
-            + RESET
-        )
-        if ip in subnet:
-            return True
+def build_ranges(subnets):
+    # Возвращаем отсортированные начала и концы диапазонов, чтобы искать в них
+    # адрес бинарным поиском
+    starts, ends = [], []
+    for start, end in sorted(map(parse_subnet, subnets)):
+        # Пересекающиеся диапазоны сливаем, иначе поиск может промахнуться
+        if ends and start <= ends[-1]:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+    return starts, ends
+
+
+def build_tree(subnets, bits, family):
+    tree = pytricia.PyTricia(bits, family)
+    for subnet in subnets:
+        tree[subnet] = True
+    return tree
+
+
+def build_v4_table(ranges):
+    # Каждый диапазон раскладываем по корзинам всех /16, которые он задевает,
+    # тогда проверка адреса сводится к индексу и паре сравнений
+    table = [None] * 65536
+    for start, end in zip(*ranges):
+        for key in range(start >> 16, (end >> 16) + 1):
+            if table[key] is None:
+                table[key] = []
+            table[key].append((start, end))
+    return table
+
+
+def init_subnets(v4_data=None, v6_data=None):
+    global _V4, _V6
+    v4_subnets, v6_subnets = load_cloudflare_subnets(v4_data, v6_data)
+    if pytricia is not None:
+        _V4 = build_tree(v4_subnets, 32, socket.AF_INET)
+        _V6 = build_tree(v6_subnets, 128, socket.AF_INET6)
+    else:
+        _V4 = build_v4_table(build_ranges(v4_subnets))
+        _V6 = build_ranges(v6_subnets)
+
+
+# Повторные хосты не должны порождать повторные запросы к DNS
+@lru_cache(maxsize=4096)
+def resolve(host):
+    # Без type getaddrinfo отдает каждый адрес по разу на тип сокета
+    sockaddr = socket.getaddrinfo(host, 0, socket.AF_UNSPEC, socket.SOCK_STREAM)[0][4]
+    # У link-local адресов IPv6 может быть указана зона: fe80::1%eth0
+    return sockaddr[0].partition("%")[0]
+
+
+def in_ranges(ranges, ip_int):
+    starts, ends = ranges
+    i = bisect_right(starts, ip_int) - 1
+    return i >= 0 and ip_int <= ends[i]
+
+
+def in_v4_table(table, ip_int):
+    bucket = table[ip_int >> 16]
+    # Обычный цикл вместо any() с генератором: в корзине почти всегда один
+    # диапазон, а генератор создавался бы на каждый хост
+    if bucket is not None:
+        for start, end in bucket:
+            if start <= ip_int <= end:
+                return True
     return False
 
 
+def is_cloudflare_ip(family, ip_int):
+    if pytricia is not None:
+        # Поиск по дереву идет в C; IPv6 pytricia принимает только байтами
+        if family == socket.AF_INET6:
+            return ip_int.to_bytes(16, "big") in _V6
+        return ip_int in _V4
+    if family == socket.AF_INET6:
+        return in_ranges(_V6, ip_int)
+    return in_v4_table(_V4, ip_int)
+
+
+def check_ip(host, ip):
+    # Общая часть проверки для резолвинга потоками и асинхронного. Аргументы
+    # log.debug форматируются только если включен уровень DEBUG
+    log.debug("resolve %s: %s", host, ip)
+    rv = is_cloudflare_ip(*parse_ip(ip))
+    log.debug("check %s in cloudflare subnets: %s", host, "-+"[rv])
+    if not rv:
+        return host, True
+    stderr(DETECTED_MSG, host, RESET, sep="")
+    return host, False
+
+
 def check_host(host):
     try:
-        if not check_cloudflare(host):
-            return host, True
-        stderr(PURPLE + "detected cloudflare: " + host + RESET)
+        ip = resolve(host)
     except socket.gaierror:
-        stderr(PURPLE + "host ip address not found: " + host + RESET)
-    return host, False
+        stderr(NOT_FOUND_MSG, host, RESET, sep="")
+        return host, False
+    return check_ip(host, ip)
+
+
+async def check_host_async(resolver, semaphore, host):
+    async with semaphore:
+        try:
+            result = await resolver.gethostbyname(host, socket.AF_UNSPEC)
+        except aiodns.error.DNSError:
+            result = None
+    # Ответ без адресов считаем таким же отказом, как и ошибку DNS
+    if result is None or not result.addresses:
+        stderr(NOT_FOUND_MSG, host, RESET, sep="")
+        return host, False
+    return check_ip(host, result.addresses[0])
 
 
-def download_file(url, path, force=False):
+async def check_hosts_async(hosts):
+    # Все запросы к DNS мультиплексируются одним циклом событий через c-ares,
+    # семафор лишь ограничивает число одновременных запросов
+    resolver = aiodns.DNSResolver()
+    semaphore = asyncio.Semaphore(ASYNC_MAX_QUERIES)
+    for coro in asyncio.as_completed(
+        [check_host_async(resolver, semaphore, host) for host in hosts]
+    ):
+        print_result(*await coro)
+
+
+def print_result(host, checked):
+    if checked:
+        print(host)
+    else:
+        stderr(SKIP_HOST_MSG, host, RESET, sep="")
+
+
+def download_file(conn, url, path, force=False):
     headers = {
         "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/115.0",
     }
@@ -176,25 +382,78 @@ def download_file(url, path, force=False):
             "If-Modified-Since": formatdate(path.stat().st_mtime, usegmt=True),
         }
 
-    req = Request(url, headers=headers)
     try:
-        with urlopen(req) as resp:
-            path.parent.mkdir(parents=True, exist_ok=True)
-            with path.open("wb+") as fp:
-                shutil.copyfileobj(resp, fp)
-            stderr(GREEN + "url " + url + " retrieved as " + str(path) + RESET)
-            return True
-    except urllib.error.URLError as err:
-        # Если файл на сервере не был модифицирован
-        if err.code == 304:
-            stderr(
-                PURPLE + "skip download: resource",
-                url,
-                "is not modified" + RESET,
-            )
+        if conn is None:
+            status, reason, data = fetch_urlopen(url, headers)
         else:
-            stderr(RED + str(err) + RESET)
-        return False
+            status, reason, data = fetch(conn, url, headers)
+            # Редиректы (в том числе на другой хост или на http) отдаем urlopen
+            if status in REDIRECT_CODES:
+                status, reason, data = fetch_urlopen(url, headers)
+    except (OSError, HTTPException) as err:
+        stderr(RED + str(err) + RESET)
+        return None
+    # Если файл на сервере не был модифицирован
+    if status == 304:
+        stderr(PURPLE + "skip download: resource", url, "is not modified" + RESET)
+        return None
+    if status != 200:
+        stderr(RED + url, status, reason + RESET)
+        return None
+    # Данные сразу разбираются из памяти, а в кеш пишутся в фоне
+    threading.Thread(target=save_file, args=(path, data)).start()
+    stderr(GREEN + "url " + url + " retrieved as " + str(path) + RESET)
+    return data
+
+
+def open_connection(url):
+    # Общее соединение нужно только без прокси: через прокси (https_proxy без
+    # совпадения в no_proxy) качаем обычным urlopen
+    parts = urlsplit(url)
+    if getproxies().get("https") and not proxy_bypass(parts.hostname):
+        return None
+    return HTTPSConnection(parts.netloc)
+
+
+def fetch(conn, url, headers):
+    try:
+        conn.request("GET", urlsplit(url).path, headers=headers)
+        # Тело читаем целиком при любом статусе, чтобы соединение можно было
+        # использовать для следующего запроса
+        with conn.getresponse() as resp:
+            return resp.status, resp.reason, resp.read()
+    except (OSError, HTTPException):
+        # После сбоя соединение остается в состоянии Request-sent, закрываем
+        # его, чтобы для следующего url http.client открыл новое
+        conn.close()
+        raise
+
+
+def fetch_urlopen(url, headers):
+    try:
+        with urlopen(Request(url, headers=headers)) as resp:
+            return resp.status, resp.reason, resp.read()
+    except HTTPError as err:
+        # urlopen сообщает о 304 и ошибочных статусах исключением
+        return err.code, err.reason, b""
+
+
+def save_file(path, data):
+    # Пишем во временный файл и подменяем им старый, чтобы параллельно
+    # запущенная копия скрипта не прочитала список наполовину
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".")
+        tmp_path = Path(tmp_name)
+        try:
+            with open(fd, "wb") as fp:
+                fp.write(data)
+            tmp_path.replace(path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+    except OSError as err:
+        stderr(RED + "can't save " + str(path) + ": " + str(err) + RESET)
 
 
 if "__main__" == __name__:
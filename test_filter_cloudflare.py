@@ -0,0 +1,374 @@
+import asyncio
+import importlib.util
+import io
+import ipaddress
+import os
+import socket
+import tempfile
+import unittest
+from http.client import HTTPSConnection
+from pathlib import Path
+from unittest import mock
+
+# Имя скрипта содержит дефис, поэтому обычный import не подходит
+_spec = importlib.util.spec_from_file_location(
+    "filter_cloudflare", Path(__file__).with_name("filter-cloudflare.py")
+)
+fc = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(fc)
+
+V4_SUBNETS = [
+    "173.245.48.0/20",
+    "103.21.244.0/22",
+    "104.16.0.0/13",
+    "104.24.0.0/14",
+    "172.64.0.0/13",
+    # Пересекающиеся и вложенные подсети проверяют слияние диапазонов
+    "10.0.0.0/8",
+    "10.1.0.0/16",
+    "1.2.3.0/24",
+    "1.2.3.128/25",
+    "1.2.4.0/24",
+    "255.255.255.255/32",
+    "0.0.0.0/32",
+]
+V6_SUBNETS = [
+    "2400:cb00::/32",
+    "2606:4700::/32",
+    "2606:4700:10::/48",
+    "::/128",
+    "ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff/128",
+]
+
+
+def edge_ips(subnets):
+    # Первый и последний адрес каждой подсети и соседние с ними
+    for subnet in subnets:
+        net = ipaddress.ip_network(subnet)
+        address = type(net.network_address)
+        first, last = int(net.network_address), int(net.broadcast_address)
+        for ip_int in (first - 1, first, first + 1, last - 1, last, last + 1):
+            if 0 <= ip_int < 2**net.max_prefixlen:
+                yield address(ip_int)
+
+
+def expected(ip, subnets):
+    return any(ip in ipaddress.ip_network(subnet) for subnet in subnets)
+
+
+class TestParse(unittest.TestCase):
+    def test_parse_subnet(self):
+        for subnet in V4_SUBNETS + V6_SUBNETS + ["0.0.0.0/0", "::/0", "1.2.3.4"]:
+            net = ipaddress.ip_network(subnet)
+            self.assertEqual(
+                fc.parse_subnet(subnet),
+                (int(net.network_address), int(net.broadcast_address)),
+                subnet,
+            )
+
+    def test_parse_subnet_host_bits(self):
+        # Биты хоста в адресе подсети отбрасываются маской
+        self.assertEqual(fc.parse_subnet("10.1.2.3/8"), fc.parse_subnet("10.0.0.0/8"))
+
+    def test_parse_ip(self):
+        self.assertEqual(fc.parse_ip("104.16.0.1"), (socket.AF_INET, 0x68100001))
+        self.assertEqual(
+            fc.parse_ip("2606:4700::1"),
+            (socket.AF_INET6, int(ipaddress.IPv6Address("2606:4700::1"))),
+        )
+
+
+class TestRanges(unittest.TestCase):
+    def test_build_ranges_merges_overlaps(self):
+        # Вложенная /25 поглощается, соседняя /24 остается отдельным диапазоном
+        starts, ends = fc.build_ranges(["1.2.3.128/25", "1.2.4.0/24", "1.2.3.0/24"])
+        self.assertEqual(
+            list(zip(starts, ends)),
+            [fc.parse_subnet("1.2.3.0/24"), fc.parse_subnet("1.2.4.0/24")],
+        )
+
+    def test_in_v4_table(self):
+        table = fc.build_v4_table(fc.build_ranges(V4_SUBNETS))
+        for ip in edge_ips(V4_SUBNETS):
+            self.assertEqual(
+                fc.in_v4_table(table, int(ip)), expected(ip, V4_SUBNETS), ip
+            )
+
+    def test_in_ranges(self):
+        for subnets in (V4_SUBNETS, V6_SUBNETS):
+            ranges = fc.build_ranges(subnets)
+            for ip in edge_ips(subnets):
+                self.assertEqual(
+                    fc.in_ranges(ranges, int(ip)), expected(ip, subnets), ip
+                )
+
+    def test_empty(self):
+        self.assertFalse(fc.in_ranges(fc.build_ranges([]), 1))
+        self.assertFalse(fc.in_v4_table(fc.build_v4_table(fc.build_ranges([])), 1))
+
+
+class IsCloudflareIpMixin:
+    def check_edges(self):
+        for ip in edge_ips(V4_SUBNETS + V6_SUBNETS):
+            subnets = V6_SUBNETS if ip.version == 6 else V4_SUBNETS
+            family = socket.AF_INET6 if ip.version == 6 else socket.AF_INET
+            self.assertEqual(
+                fc.is_cloudflare_ip(family, int(ip)), expected(ip, subnets), ip
+            )
+
+
+class TestIsCloudflareIp(IsCloudflareIpMixin, unittest.TestCase):
+    def test_fallback(self):
+        with mock.patch.multiple(
+            fc,
+            pytricia=None,
+            _V4=fc.build_v4_table(fc.build_ranges(V4_SUBNETS)),
+            _V6=fc.build_ranges(V6_SUBNETS),
+        ):
+            self.check_edges()
+
+    @unittest.skipIf(fc.pytricia is None, "pytricia is not installed")
+    def test_pytricia(self):
+        with mock.patch.multiple(
+            fc,
+            _V4=fc.build_tree(V4_SUBNETS, 32, socket.AF_INET),
+            _V6=fc.build_tree(V6_SUBNETS, 128, socket.AF_INET6),
+        ):
+            self.check_edges()
+
+
+class FakeResolver:
+    def __init__(self, answers):
+        self.answers = answers
+
+    async def gethostbyname(self, host, family):
+        answer = self.answers[host]
+        if isinstance(answer, Exception):
+            raise answer
+        return mock.Mock(addresses=answer)
+
+
+class TestCheckHostAsync(unittest.TestCase):
+    def check(self, answer):
+        resolver = FakeResolver({"example.com": answer})
+
+        async def run():
+            return await fc.check_host_async(
+                resolver, asyncio.Semaphore(1), "example.com"
+            )
+
+        with mock.patch.multiple(
+            fc,
+            pytricia=None,
+            _V4=fc.build_v4_table(fc.build_ranges(V4_SUBNETS)),
+            _V6=fc.build_ranges(V6_SUBNETS),
+        ), mock.patch.object(fc, "stderr"):
+            return asyncio.run(run())
+
+    def test_cloudflare(self):
+        self.assertEqual(self.check(["104.16.0.1"]), ("example.com", False))
+        self.assertEqual(self.check(["2606:4700::1"]), ("example.com", False))
+
+    def test_not_cloudflare(self):
+        self.assertEqual(self.check(["8.8.8.8"]), ("example.com", True))
+
+    def test_empty_answer(self):
+        self.assertEqual(self.check([]), ("example.com", False))
+
+    @unittest.skipIf(fc.aiodns is None, "aiodns is not installed")
+    def test_not_found(self):
+        self.assertEqual(
+            self.check(fc.aiodns.error.DNSError(4, "not found")),
+            ("example.com", False),
+        )
+
+
+def fake_getaddrinfo(answers):
+    def getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+        ip = answers.get(host)
+        if ip is None:
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        ip_family = socket.AF_INET6 if ":" in ip else socket.AF_INET
+        sockaddr = (ip, port, 0, 0) if ip_family == socket.AF_INET6 else (ip, port)
+        return [(ip_family, socket.SOCK_STREAM, 6, "", sockaddr)]
+
+    return getaddrinfo
+
+
+class TestCheckHost(unittest.TestCase):
+    answers = {
+        "v4.example.com": "104.16.0.1",
+        "v6.example.com": "2606:4700::1",
+        "other.example.com": "8.8.8.8",
+        "zone.example.com": "2606:4700::2%eth0",
+    }
+
+    def setUp(self):
+        fc.resolve.cache_clear()
+        self.addCleanup(fc.resolve.cache_clear)
+        for patcher in (
+            mock.patch.multiple(
+                fc,
+                pytricia=None,
+                _V4=fc.build_v4_table(fc.build_ranges(V4_SUBNETS)),
+                _V6=fc.build_ranges(V6_SUBNETS),
+            ),
+            mock.patch.object(fc, "stderr"),
+            mock.patch.object(fc.socket, "getaddrinfo", fake_getaddrinfo(self.answers)),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_v4_cloudflare(self):
+        self.assertEqual(fc.check_host("v4.example.com"), ("v4.example.com", False))
+
+    def test_v6_cloudflare(self):
+        self.assertEqual(fc.check_host("v6.example.com"), ("v6.example.com", False))
+        self.assertEqual(fc.check_host("zone.example.com"), ("zone.example.com", False))
+
+    def test_not_cloudflare(self):
+        self.assertEqual(
+            fc.check_host("other.example.com"), ("other.example.com", True)
+        )
+
+    def test_not_found(self):
+        self.assertEqual(
+            fc.check_host("missing.example.com"), ("missing.example.com", False)
+        )
+        fc.stderr.assert_called_once_with(
+            fc.NOT_FOUND_MSG, "missing.example.com", fc.RESET, sep=""
+        )
+
+
+class FakeResponse(io.BytesIO):
+    def __init__(self, status, body=b"", reason="OK"):
+        super().__init__(body)
+        self.status, self.reason = status, reason
+
+
+class FakeConnection:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.paths = []
+        self.close = mock.Mock()
+
+    def request(self, method, path, headers):
+        self.paths.append(path)
+        if isinstance(self.responses[0], Exception):
+            raise self.responses.pop(0)
+
+    def getresponse(self):
+        return self.responses.pop(0)
+
+
+class TestDownload(unittest.TestCase):
+    url = "https://www.cloudflare.com/ips-v4/"
+
+    def setUp(self):
+        for target in ("stderr", "threading", "urlopen"):
+            patcher = mock.patch.object(fc, target)
+            setattr(self, target, patcher.start())
+            self.addCleanup(patcher.stop)
+        self.path = Path("/nonexistent/ips-v4")
+
+    def download(self, conn):
+        return fc.download_file(conn, self.url, self.path)
+
+    def test_ok(self):
+        conn = FakeConnection(FakeResponse(200, b"104.16.0.0/13\n"))
+        self.assertEqual(self.download(conn), b"104.16.0.0/13\n")
+        self.assertEqual(conn.paths, ["/ips-v4/"])
+        self.threading.Thread.assert_called_once_with(
+            target=fc.save_file, args=(self.path, b"104.16.0.0/13\n")
+        )
+        self.urlopen.assert_not_called()
+
+    def test_not_modified(self):
+        conn = FakeConnection(FakeResponse(304, reason="Not Modified"))
+        self.assertIsNone(self.download(conn))
+        self.threading.Thread.assert_not_called()
+
+    def test_error_status(self):
+        conn = FakeConnection(FakeResponse(404, b"nope", "Not Found"))
+        self.assertIsNone(self.download(conn))
+        self.threading.Thread.assert_not_called()
+
+    def test_redirect_same_host(self):
+        # Редиректы отдаются urlopen, он же их и проходит
+        conn = FakeConnection(FakeResponse(301, reason="Moved"))
+        self.urlopen.return_value = FakeResponse(200, b"1.2.3.0/24\n")
+        self.assertEqual(self.download(conn), b"1.2.3.0/24\n")
+        self.assertEqual(self.urlopen.call_args.args[0].full_url, self.url)
+
+    def test_redirect_other_host(self):
+        conn = FakeConnection(FakeResponse(302, reason="Found"))
+        self.urlopen.return_value = FakeResponse(200, b"1.2.3.0/24\n")
+        self.assertEqual(self.download(conn), b"1.2.3.0/24\n")
+        # Общее соединение после редиректа остается пригодным
+        self.assertEqual(conn.responses, [])
+        conn.close.assert_not_called()
+
+    def test_too_many_redirects(self):
+        conn = FakeConnection(FakeResponse(302, reason="Found"))
+        self.urlopen.side_effect = fc.HTTPError(
+            self.url, 302, "infinite loop", {}, None
+        )
+        self.assertIsNone(self.download(conn))
+        self.threading.Thread.assert_not_called()
+
+    def test_connection_error(self):
+        conn = FakeConnection(OSError("Name or service not known"))
+        self.assertIsNone(self.download(conn))
+        conn.close.assert_called_once()
+
+    def test_proxy(self):
+        self.urlopen.return_value = FakeResponse(200, b"1.2.3.0/24\n")
+        self.assertEqual(self.download(None), b"1.2.3.0/24\n")
+
+
+class TestOpenConnection(unittest.TestCase):
+    url = "https://www.cloudflare.com/ips-v4/"
+
+    def open(self, **env):
+        with mock.patch.dict(os.environ, env, clear=True):
+            return fc.open_connection(self.url)
+
+    def test_direct(self):
+        conn = self.open()
+        self.assertIsInstance(conn, HTTPSConnection)
+        self.assertEqual(conn.host, "www.cloudflare.com")
+
+    def test_proxy(self):
+        self.assertIsNone(self.open(https_proxy="http://127.0.0.1:3128"))
+
+    def test_no_proxy(self):
+        conn = self.open(
+            https_proxy="http://127.0.0.1:3128", no_proxy="www.cloudflare.com"
+        )
+        self.assertIsInstance(conn, HTTPSConnection)
+
+
+class TestSaveFile(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = Path(tmp.name)
+
+    def test_save(self):
+        path = self.dir / "cache" / "ips-v4"
+        fc.save_file(path, b"old")
+        fc.save_file(path, b"104.16.0.0/13\n")
+        self.assertEqual(path.read_bytes(), b"104.16.0.0/13\n")
+        # Временные файлы не остаются
+        self.assertEqual(list(path.parent.iterdir()), [path])
+
+    def test_error(self):
+        # Родитель списка - файл, поэтому каталог кеша создать нельзя
+        (self.dir / "cache").write_bytes(b"")
+        with mock.patch.object(fc, "stderr") as stderr:
+            fc.save_file(self.dir / "cache" / "ips-v4", b"data")
+        stderr.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()